@@ -1,14 +1,21 @@
 # server.py
-import os, re, time, io, zipfile, uuid, shutil
+import os, re, zipfile, uuid, asyncio, hashlib, random, threading
+from contextlib import aclosing, asynccontextmanager
+from functools import lru_cache
+from html import escape as html_escape
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import AsyncIterator, Dict, Final, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
+import aiofiles
 import httpx
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+import orjson
+from cachetools import LRUCache, TTLCache
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 # ---------- Verzeichnisse ----------
 BASE_DIR = Path(__file__).resolve().parent
@@ -18,9 +25,24 @@ BUNDLES_DIR = BASE_DIR / "bundles"
 BUNDLES_DIR.mkdir(exist_ok=True)
 
 # ---------- Provider-Konfiguration ----------
-from dotenv import load_dotenv; load_dotenv()
+load_dotenv()
 OLLAMA_API_KEY    = os.getenv("OLLAMA_API_KEY", "").strip()
 OLLAMA_CLOUD_BASE = os.getenv("OLLAMA_CLOUD_BASE", "https://ollama.com/v1").rstrip("/")
+OLLAMA_POOL_KEEPALIVE = int(os.getenv("OLLAMA_POOL_KEEPALIVE", "20"))
+OLLAMA_POOL_MAX       = int(os.getenv("OLLAMA_POOL_MAX", "100"))
+
+# ---------- Redis (optional, geteilter Cache für mehrere Worker) ----------
+REDIS_URL       = os.getenv("REDIS_URL", "").strip()
+REDIS_CACHE_TTL = int(os.getenv("REDIS_CACHE_TTL", "86400"))
+# kurz halten: ein hängendes Redis soll wie ein Miss wirken, nicht /generate ausbremsen
+REDIS_TIMEOUT   = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+
+# ---------- Semantic Cache (optional, Redis + redisvl) ----------
+SEMANTIC_CACHE_URL      = os.getenv("SEMANTIC_CACHE_URL", "").strip()
+SEMANTIC_CACHE_DISTANCE = float(os.getenv("SEMANTIC_CACHE_DISTANCE", "0.1"))
+# ohne Redis: lokales Embedding-Modell, z. B. "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_MODEL    = os.getenv("SEMANTIC_CACHE_MODEL", "").strip()
+SEMANTIC_CACHE_MIN_SIM  = float(os.getenv("SEMANTIC_CACHE_MIN_SIM", "0.92"))
 
 # ---------- Modell-Presets ----------
 MODEL_PRESETS = {
@@ -42,13 +64,35 @@ MODEL_ALIASES = {
     "gpt-oss:20b": "gpt-oss:20b-cloud",
 }
 
+# grobe Obergrenze für den Prompt (~3 Zeichen pro Token), damit offensichtlich zu
+# lange Eingaben gar nicht erst zum Provider gehen
+MAX_PROMPT_CHARS = {m: int(p["context_window"] * 3) for m, p in MODEL_PRESETS.items()}
+
+# Exakte Lookup-Tabelle: Aliase, kanonische Namen und eindeutige Familien-Präfixe
+# (z. B. "deepseek-v3.1"); "gpt-oss" ist mehrdeutig und fällt deshalb raus.
+_FAMILIES: Dict[str, List[str]] = {}
+for _canon in MODEL_PRESETS:
+    _FAMILIES.setdefault(_canon.split(":")[0], []).append(_canon)
+_MODEL_RESOLVE: Dict[str, str] = (
+    {fam: c[0] for fam, c in _FAMILIES.items() if len(c) == 1}
+    | MODEL_ALIASES
+    | {canon: canon for canon in MODEL_PRESETS}
+)
+
 def resolve_model(name: str) -> str:
     n = (name or "").strip().lower()
-    for key, canonical in MODEL_ALIASES.items():
-        if key in n:
-            return canonical
-    return name if name in MODEL_PRESETS else "qwen3-coder:480b-cloud"
-
+    return _MODEL_RESOLVE.get(n) or _MODEL_RESOLVE.get(n.split(":")[0]) or "qwen3-coder:480b-cloud"
+
+def adaptive_max_tokens(model: str, prompt: str) -> int:
+    # Ausgabe-Budget, wenn der Client keins vorgibt: nie unter ideal_max – der Systemprompt
+    # verlangt immer Hero, Galerie und Features, auch bei kurzem Prompt. Lange Prompts
+    # bekommen mehr (cap greift danach in choose_tokens_and_temp); Leerlauf nach </html>
+    # kostet nichts, weil der Stream dort abbricht.
+    ideal = int(MODEL_PRESETS[resolve_model(model)]["ideal_max"])
+    return max(ideal, 400 + 6 * len(prompt.split()))
+
+# gecacht pro (Modell, max_tokens, temperature); das meta-dict wird geteilt und nie verändert
+@lru_cache(maxsize=256)
 def choose_tokens_and_temp(model: str, requested_max: Optional[int], req_temp: Optional[float]):
     canon = resolve_model(model)
     preset = MODEL_PRESETS.get(canon, MODEL_PRESETS["qwen3-coder:480b-cloud"])
@@ -67,209 +111,652 @@ def choose_tokens_and_temp(model: str, requested_max: Optional[int], req_temp: O
     return chosen_max, temperature, meta
 
 # ---------- App ----------
-app = FastAPI(title="Website-Generator KI")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Ein gemeinsamer Client für alle Provider-Calls: Keep-Alive-Pool statt neuem TLS-Handshake pro Request
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=OLLAMA_POOL_KEEPALIVE,
+            max_connections=OLLAMA_POOL_MAX,
+            keepalive_expiry=60.0,
+        ),
+        # read gilt beim Streaming pro Chunk; große Modelle brauchen bis zum ersten Token teils > 60 s
+        timeout=httpx.Timeout(connect=10.0, read=120.0, write=30.0, pool=30.0),
+    )
+    try:
+        yield
+    finally:
+        if _BG_TASKS:  # ausstehende Cache-Writes noch abschließen
+            await asyncio.gather(*_BG_TASKS, return_exceptions=True)
+        await app.state.http.aclose()
+        if redis_cache is not None:
+            await redis_cache.aclose()
+
+class ORJSONResponse(JSONResponse):
+    # orjson statt stdlib-json für die großen HTML-Antworten
+    media_type = "application/json"
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(title="Website-Generator KI", lifespan=lifespan, default_response_class=ORJSONResponse)
+# Kommagetrennt, z. B. "https://meine-seite.netlify.app,https://xyz.onrender.com"
+# frozenset: CORSMiddleware prüft die Origin per Set-Lookup statt Listen-Scan
+ALLOW_ORIGINS = frozenset(o.strip() for o in os.getenv("ALLOW_ORIGINS", "*").split(",") if o.strip())
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=ALLOW_ORIGINS,
     allow_credentials=False,
     allow_methods=["GET","POST","OPTIONS"],
-    allow_headers=["*"],
+    allow_headers=["Content-Type","Authorization"],
+    max_age=86400,  # Preflight 24 h im Browser cachen
 )
-app.mount("/static", StaticFiles(directory=str(PUBLIC_DIR)), name="static")
+class CachedStaticFiles(StaticFiles):
+    # StaticFiles beantwortet If-None-Match/If-Modified-Since schon mit 304, setzt aber kein Cache-Control
+    def file_response(self, *args, **kwargs) -> Response:
+        resp = super().file_response(*args, **kwargs)
+        resp.headers.setdefault("Cache-Control", "public, max-age=86400")
+        return resp
+
+app.mount("/static", CachedStaticFiles(directory=str(PUBLIC_DIR)), name="static")
 
 INDEX_FILE = BASE_DIR / "index.html"
+# einmal beim Start lesen: kein stat/read pro Aufruf, ETag aus dem Inhalt
+_INDEX_BYTES = INDEX_FILE.read_bytes() if INDEX_FILE.exists() else None
+_INDEX_ETAG = f'"{hashlib.blake2b(_INDEX_BYTES, digest_size=8).hexdigest()}"' if _INDEX_BYTES else None
 
 @app.get("/", response_class=HTMLResponse)
-def root():
-    if INDEX_FILE.exists():
-        return INDEX_FILE.read_text(encoding="utf-8")
-    return HTMLResponse("<h1>index.html fehlt</h1>", status_code=404)
+def root(request: Request):
+    if _INDEX_BYTES is None:
+        return HTMLResponse("<h1>index.html fehlt</h1>", status_code=404)
+    headers = {"ETag": _INDEX_ETAG, "Cache-Control": "public, max-age=300"}
+    if is_not_modified(request, _INDEX_ETAG):
+        return Response(status_code=304, headers=headers)
+    return Response(_INDEX_BYTES, media_type="text/html; charset=utf-8", headers=headers)
 
 @app.get("/health")
 def health():
     return {"ok": True, "api_key_set": bool(OLLAMA_API_KEY), "base": OLLAMA_CLOUD_BASE}
 
 # ---------- Schemas ----------
-from typing import Dict
 class GenReq(BaseModel):
+    # unbekannte Felder ignorieren, keine Zusatzarbeit bei Zuweisung/Whitespace
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=False, validate_assignment=False)
+
     prompt: str
     model: Optional[str] = "qwen3-coder:480b-cloud"
     max_tokens: Optional[int] = None
     temperature: Optional[float] = None
     bundle_id: Optional[str] = None
     image_names: Optional[List[str]] = None
+    stream: bool = False
 
 # ---------- Helpers ----------
 SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9._-]+")
+FENCE_OPEN_RE  = re.compile(r"^\s*```[a-zA-Z0-9]*\s*")
+FENCE_CLOSE_RE = re.compile(r"\s*```\s*$")
+ASSETS_REL_RE  = re.compile(r'(["\'(])assets/')
+HAS_HTML_RE    = re.compile(r"<html", re.IGNORECASE)
+END_HTML_RE    = re.compile(r"</html\s*>", re.IGNORECASE)
 def safe_name(name: str) -> str:
     name = SAFE_NAME_RE.sub("", name.strip().replace(" ", "_"))
     return name.lstrip(".").replace("/", "").replace("\\", "") or f"file_{uuid.uuid4().hex[:8]}"
 
+def unique_names(filenames: Iterable[str]) -> List[str]:
+    # gleiche Namen in einem Upload (Browser schicken gern mehrmals "image.jpg") -> image-1.jpg, ...
+    seen: set = set()
+    out: List[str] = []
+    for raw in filenames:
+        name = safe_name(raw)
+        stem, suffix = os.path.splitext(name)
+        n = 1
+        while name in seen:
+            name = f"{stem}-{n}{suffix}"
+            n += 1
+        seen.add(name)
+        out.append(name)
+    return out
+
 def strip_fences(txt: str) -> str:
     if not txt: return txt
-    txt = re.sub(r"^\s*```[a-zA-Z0-9]*\s*", "", txt.strip())
-    txt = re.sub(r"\s*```\s*$", "", txt)
+    # Fences kommen höchstens einmal vor: count=1 bricht nach dem ersten Treffer ab
+    txt = FENCE_OPEN_RE.sub("", txt.strip(), count=1)
+    txt = FENCE_CLOSE_RE.sub("", txt, count=1)
     return txt.strip()
 
-async def call_provider(payload: dict) -> dict:
+FALLBACK_PRE: Final[str] = (
+    "<!DOCTYPE html><html lang='de'><head><meta charset='utf-8'>"
+    "<meta name='viewport' content='width=device-width,initial-scale=1'>"
+    "<title>Entwurf</title><style>body{font-family:Arial;padding:24px;max-width:900px;margin:0 auto}</style>"
+    "</head><body><h1>Entwurf</h1><pre>"
+)
+FALLBACK_POST: Final[str] = "</pre></body></html>"
+
+# liefert (html, ist_vollständiges_dokument); sonst Fallback-Seite mit dem Rohtext.
+# ended: Modell hat regulär aufgehört (</html> gesehen oder finish_reason "stop") –
+# ein bei max_tokens abgeschnittenes Dokument enthält zwar "<html", ist aber kaputt.
+def finish_html(content: str, ended: bool) -> Tuple[str, bool]:
+    html = strip_fences(content)
+    if not ended or not html or not HAS_HTML_RE.search(html):
+        # Rohtext escapen: ein "</pre>" oder "<script>" in der Modellantwort darf die Seite nicht brechen
+        return FALLBACK_PRE + html_escape(content) + FALLBACK_POST, False
+    return html, True
+
+# 429 = Rate-Limit: ebenfalls mit Backoff erneut versuchen
+RETRIABLE_STATUS: frozenset = frozenset({408, 429, 502, 503, 504})
+
+def jittered(delay: float) -> float:
+    # 0.5x–1.5x, damit parallele Clients nach einem 503 nicht im Gleichtakt erneut anfragen
+    return delay * (0.5 + random.random())
+
+# liefert die SSE-Chunks des Providers (stream=True) einzeln als dict
+async def stream_provider(client: httpx.AsyncClient, payload: dict) -> AsyncIterator[dict]:
     if not OLLAMA_API_KEY:
         raise HTTPException(status_code=500, detail="OLLAMA_API_KEY fehlt")
     url = f"{OLLAMA_CLOUD_BASE}/chat/completions"
     headers = {"Authorization": f"Bearer {OLLAMA_API_KEY}", "Content-Type": "application/json"}
-    limits  = httpx.Limits(max_keepalive_connections=2, max_connections=4)
-    timeout = httpx.Timeout(connect=10.0, read=60.0, write=20.0, pool=20.0)
-    retriable = {408, 502, 503, 504}
-    async with httpx.AsyncClient(http2=False, limits=limits, timeout=timeout) as client:
-        backoff = 1.0
-        for attempt in range(2):
-            try:
-                r = await client.post(url, headers=headers, json=payload)
-                if r.status_code in retriable and attempt == 0:
-                    time.sleep(backoff); backoff *= 2; continue
+    body = orjson.dumps(payload)  # einmal serialisieren, auch für den Retry
+    backoff = 1.0
+    for attempt in range(2):
+        started = False
+        try:
+            async with client.stream("POST", url, headers=headers, content=body) as r:
+                if r.status_code in RETRIABLE_STATUS and attempt == 0:
+                    await r.aclose(); await asyncio.sleep(jittered(backoff)); backoff *= 2; continue
                 if r.status_code >= 400:
-                    raise HTTPException(status_code=502, detail=f"Provider {r.status_code}: {r.text[:400]}")
-                return r.json()
-            except httpx.RequestError as e:
-                if attempt == 0:
-                    time.sleep(1.5); continue
-                raise HTTPException(status_code=502, detail=f"Netzwerkfehler: {e}")
+                    err = (await r.aread()).decode("utf-8", "replace")
+                    raise HTTPException(status_code=502, detail=f"Provider {r.status_code}: {err[:400]}")
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    started = True
+                    yield orjson.loads(data)
+                return
+        except httpx.RequestError as e:
+            # nur neu versuchen, solange noch nichts an den Client weitergereicht wurde
+            if attempt == 0 and not started:
+                await asyncio.sleep(jittered(1.5)); continue
+            raise HTTPException(status_code=502, detail=f"Netzwerkfehler: {e}")
+
+# ---------- Cache ----------
+# Exakte Wiederholungen (gleiches Modell, gleiche Parameter, gleicher Prompt + Bilder)
+# werden prozesslokal beantwortet, ohne Embedding oder Netzwerk.
+_LLM_CACHE: TTLCache = TTLCache(maxsize=512, ttl=3600)
+
+# laufende Provider-Calls je cache_key (Single-Flight): Duplikate warten auf dasselbe Future
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+# Cache-Writes laufen im Hintergrund; Referenzen halten, sonst kann der GC die Tasks abräumen
+_BG_TASKS: set = set()
+
+def in_background(coro) -> None:
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+
+# zweite Stufe hinter _LLM_CACHE: überlebt Redeploys und ist für alle Worker gleich
+redis_cache = None
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    redis_cache = aioredis.from_url(
+        REDIS_URL, decode_responses=False,
+        socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT,
+    )
+
+async def exact_lookup(key: str) -> Optional[str]:
+    html = _LLM_CACHE.get(key)
+    if html is not None or redis_cache is None:
+        return html
+    try:
+        raw = await redis_cache.get(f"gen:{key}")
+    except Exception:
+        return None  # Redis weg: wie ein Miss behandeln
+    if raw is None:
+        return None
+    html = raw.decode("utf-8")
+    _LLM_CACHE[key] = html
+    return html
+
+async def redis_store(key: str, html: str) -> None:
+    if redis_cache is None:
+        return
+    try:
+        await redis_cache.set(f"gen:{key}", html.encode("utf-8"), ex=REDIS_CACHE_TTL)
+    except Exception:
+        pass
+
+def cache_key(model: str, temperature: float, max_tokens: int, user: str) -> str:
+    # Bildnamen stehen bereits im Bilder-Block von user. user ist das einzige freie Feld und
+    # steht am Ende – ein \0 im Prompt kann die Feldgrenzen davor also nicht verschieben.
+    raw = "\0".join([model, str(temperature), str(max_tokens), user])
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+# Findet inhaltlich gleiche Prompts ("Bäckerei One-Pager" vs. "One-Page für eine Bäckerei")
+# über Embedding-Ähnlichkeit. Redis-Variante, wenn SEMANTIC_CACHE_URL gesetzt ist.
+semantic_cache = None
+if SEMANTIC_CACHE_URL:
+    from redisvl.extensions.cache.llm import SemanticCache
+    from redisvl.query.filter import Tag
+    # Modell/Temperatur/Bilder sind harte Filter, eingebettet wird nur der Nutzer-Prompt.
+    # Neuer Index-Name, weil sich das Schema gegenüber der alten Variante geändert hat.
+    semantic_cache = SemanticCache(
+        name="website_generator_v2",
+        redis_url=SEMANTIC_CACHE_URL,
+        distance_threshold=SEMANTIC_CACHE_DISTANCE,
+        filterable_fields=[
+            {"name": "model", "type": "tag"},
+            {"name": "temp", "type": "tag"},
+            {"name": "images", "type": "tag"},
+        ],
+    )
+
+class LocalSemanticCache:
+    # Prozesslokale Variante: normierte Prompt-Vektoren als float16-Matrix je Scope
+    # (Modell/Temperatur/Bilder); Ähnlichkeit = Skalarprodukt, Treffer ab min_sim.
+    # Scopes liegen in einem LRU – jedes Bundle mit eigenen Bildnamen bringt einen neuen mit.
+    def __init__(self, encoder, min_sim: float, max_entries: int = 512, max_scopes: int = 256):
+        self.encoder = encoder
+        self.min_sim = min_sim
+        self.max_entries = max_entries
+        self.scopes: LRUCache = LRUCache(maxsize=max_scopes)
+        # check/store laufen per to_thread parallel; LRUCache ist nicht threadsicher
+        self.lock = threading.Lock()
+
+    def embed(self, text: str) -> "np.ndarray":
+        return self.encoder.encode(text, normalize_embeddings=True).astype(np.float16)
+
+    def check(self, scope: str, prompt: str) -> Optional[str]:
+        with self.lock:
+            entry = self.scopes.get(scope)
+        if entry is None:
+            return None
+        vecs, htmls = entry
+        sims = vecs @ self.embed(prompt)
+        i = int(sims.argmax())
+        return htmls[i] if float(sims[i]) >= self.min_sim else None
+
+    def store(self, scope: str, prompt: str, html: str) -> None:
+        v = self.embed(prompt)  # teuer, daher außerhalb des Locks
+        with self.lock:
+            vecs, htmls = self.scopes.get(scope, (np.empty((0, v.shape[0]), dtype=np.float16), []))
+            # älteste Einträge fallen raus; Tupel wird als Ganzes ersetzt, Leser sehen nie halbe Stände
+            self.scopes[scope] = (np.vstack([vecs, v[None, :]])[-self.max_entries:], (htmls + [html])[-self.max_entries:])
+
+local_semantic = None
+if SEMANTIC_CACHE_MODEL and semantic_cache is None:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    local_semantic = LocalSemanticCache(SentenceTransformer(SEMANTIC_CACHE_MODEL), SEMANTIC_CACHE_MIN_SIM)
+
+class SemanticKey(NamedTuple):
+    model: str
+    temp: str    # gebucketete Temperatur
+    images: str  # Hash der Bildnamen, hält den Tag-Wert kurz
+    prompt: str  # reiner Nutzer-Prompt – nur der wird eingebettet
+
+    @property
+    def filters(self) -> Dict[str, str]:
+        return {"model": self.model, "temp": self.temp, "images": self.images}
+
+    @property
+    def scope(self) -> str:
+        return "\0".join([self.model, self.temp, self.images])
+
+def semantic_key(model: str, temperature: float, prompt: str, names: List[str]) -> SemanticKey:
+    # Temperatur grob bucketen, damit 0.20 und 0.21 denselben Eintrag teilen.
+    # Der feste Systemprompt bleibt draußen, er würde jedes Embedding dominieren.
+    images = hashlib.blake2b("\0".join(names).encode("utf-8"), digest_size=8).hexdigest()
+    return SemanticKey(model, str(round(temperature, 1)), images, prompt)
+
+def semantic_filter(sk: SemanticKey):
+    return (Tag("model") == sk.model) & (Tag("temp") == sk.temp) & (Tag("images") == sk.images)
+
+async def semantic_lookup(sk: SemanticKey) -> Optional[str]:
+    try:
+        if semantic_cache is not None:
+            hits = await asyncio.to_thread(semantic_cache.check, prompt=sk.prompt, num_results=1,
+                                           filter_expression=semantic_filter(sk))
+            return hits[0].get("response") if hits else None
+        if local_semantic is not None:
+            return await asyncio.to_thread(local_semantic.check, sk.scope, sk.prompt)
+    except Exception:
+        pass  # Cache-Ausfall darf /generate nicht blockieren
+    return None
+
+async def semantic_store(sk: SemanticKey, html: str, model: str) -> None:
+    try:
+        if semantic_cache is not None:
+            await asyncio.to_thread(semantic_cache.store, prompt=sk.prompt, response=html,
+                                    metadata={"model": model}, filters=sk.filters)
+        elif local_semantic is not None:
+            await asyncio.to_thread(local_semantic.store, sk.scope, sk.prompt, html)
+    except Exception:
+        pass
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    if inm == etag:  # Normalfall: Browser schickt genau den einen ETag zurück
+        return True
+    tags = [t.strip().removeprefix("W/") for t in inm.split(",")]
+    return "*" in tags or etag in tags
+
+# ETags der Bundle-Assets liegen als Sidecar neben (nicht in) assets/, damit sie weder
+# in der Bildliste für den Prompt noch im ZIP auftauchen.
+ETAGS_DIRNAME = ".etags"
+def etag_path(bundle_id: str, name: str) -> Path:
+    return BUNDLES_DIR / bundle_id / ETAGS_DIRNAME / name
 
 def ensure_bundle(bundle_id: Optional[str]) -> str:
     bid = bundle_id or uuid.uuid4().hex[:12]
     (BUNDLES_DIR / bid / "assets").mkdir(parents=True, exist_ok=True)
+    (BUNDLES_DIR / bid / ETAGS_DIRNAME).mkdir(exist_ok=True)
     return bid
 
-def write_html(bundle_id: str, html: str) -> Path:
+# Asset-Liste pro Bundle; gültig, solange sich die mtime von assets/ nicht ändert.
+# Begrenzt, weil jedes /generate ohne bundle_id ein neues Bundle anlegt.
+_BUNDLE_ASSETS: LRUCache = LRUCache(maxsize=1024)
+
+def list_assets(bundle_id: str) -> List[str]:
+    assets_dir = BUNDLES_DIR / bundle_id / "assets"
+    mtime = assets_dir.stat().st_mtime
+    cached = _BUNDLE_ASSETS.get(bundle_id)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    names = sorted(p.name for p in assets_dir.iterdir() if p.is_file())
+    _BUNDLE_ASSETS[bundle_id] = (mtime, names)
+    return names
+
+async def write_html(bundle_id: str, html: str) -> Path:
     out = BUNDLES_DIR / bundle_id / "index.html"
-    out.write_text(html, encoding="utf-8")
+    async with aiofiles.open(out, "w", encoding="utf-8") as f:
+        await f.write(html)
     return out
 
+@lru_cache(maxsize=128)
+def _img_names_pattern(bases: Tuple[str, ...]) -> re.Pattern:
+    # längste Namen zuerst, damit die Alternation deterministisch bleibt
+    alts = "|".join(re.escape(b) for b in sorted(bases, key=len, reverse=True))
+    return re.compile(rf'(["\'(])({alts})([)"\'])')
+
 def fix_img_paths_relative(html: str, image_names: List[str]) -> str:
-    # sorge dafür, dass nackte Dateinamen zu assets/NAME werden
-    for name in image_names:
-        base = name.split("/")[-1]
-        html = re.sub(rf'(["\'(]){re.escape(base)}([)"\'])', rf'\1assets/{base}\2', html)
-    return html
+    # sorge dafür, dass nackte Dateinamen zu assets/NAME werden – ein Durchlauf für alle Namen
+    bases = tuple(sorted({name.split("/")[-1] for name in image_names}))
+    if not bases:
+        return html
+    return _img_names_pattern(bases).sub(r"\1assets/\2\3", html)
 
 def absolutize_for_preview(html: str, bundle_id: str) -> str:
     # assets/... -> /bundles/{id}/assets/...
-    return re.sub(r'(["\'(])assets/', rf'\1/bundles/{bundle_id}/assets/', html)
+    return ASSETS_REL_RE.sub(rf'\1/bundles/{bundle_id}/assets/', html)
 
 # ---------- Upload ----------
+UPLOAD_CHUNK = 1 << 16
+# begrenzt gleichzeitig offene Upload-Dateien prozessweit (Schutz vor fd-Erschöpfung)
+_UPLOAD_SEM = asyncio.Semaphore(8)
 @app.post("/upload")
 async def upload(files: List[UploadFile] = File(...), bundle_id: Optional[str] = Form(None)):
     bid = ensure_bundle(bundle_id)
     assets_dir = BUNDLES_DIR / bid / "assets"
-    saved = []
-    for uf in files:
-        name = safe_name(uf.filename or "upload")
-        (assets_dir / name).write_bytes(await uf.read())
-        saved.append(name)
+
+    async def save(uf: UploadFile, name: str) -> str:
+        # in 64-KB-Stücken in eine Temp-Datei unter .etags/ (gleiches Dateisystem, nicht im ZIP),
+        # dann per os.replace atomar ans Ziel – parallele Uploads desselben Namens zerreißen nichts
+        digest = hashlib.md5()
+        tmp = etag_path(bid, f"{name}.{uuid.uuid4().hex[:8]}.part")
+        async with _UPLOAD_SEM:
+            try:
+                async with aiofiles.open(tmp, "wb") as f:
+                    while chunk := await uf.read(UPLOAD_CHUNK):
+                        digest.update(chunk)
+                        await f.write(chunk)
+                os.replace(tmp, assets_dir / name)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+            # Sidecar aus demselben Digest, ebenfalls atomar ersetzt
+            async with aiofiles.open(tmp, "w") as f:
+                await f.write(f'"{digest.hexdigest()}"')
+            os.replace(tmp, etag_path(bid, name))
+        return name
+
+    saved = list(await asyncio.gather(*(save(uf, name) for uf, name in
+                                        zip(files, unique_names(uf.filename or "upload" for uf in files)))))
+    _BUNDLE_ASSETS.pop(bid, None)
     return {"bundle_id": bid, "assets": saved}
 
 # ---------- Serve bundle assets for preview ----------
 @app.get("/bundles/{bundle_id}/assets/{filename:path}")
-def serve_bundle_asset(bundle_id: str, filename: str):
+def serve_bundle_asset(bundle_id: str, filename: str, request: Request):
     safe = safe_name(Path(filename).name)
     file_path = BUNDLES_DIR / bundle_id / "assets" / safe
-    if not file_path.exists():
+    try:
+        st = os.stat(file_path)
+    except OSError:
         raise HTTPException(status_code=404, detail="asset not found")
-    return FileResponse(str(file_path))
+    # no-cache statt max-age: ein erneuter Upload von logo.png überschreibt dieselbe URL.
+    # Der Browser fragt jedes Mal per If-None-Match nach, unverändert kommt nur ein 304.
+    headers = {"Cache-Control": "no-cache"}
+    try:
+        headers["ETag"] = etag_path(bundle_id, safe).read_text().strip()
+    except OSError:
+        pass  # ältere Uploads ohne Sidecar: Starlette-ETag aus mtime/size
+    if "ETag" in headers and is_not_modified(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(str(file_path), stat_result=st, headers=headers)
 
 # ---------- Generate ----------
+# Strenger Systemprompt: Bilder MÜSSEN eingebaut werden. Enthält alle festen Anweisungen und
+# ist über Requests und Neustarts byte-identisch – Provider mit Prompt-Caching erkennen das Präfix.
+SYSTEM_PROMPT: Final[str] = (
+    "Du bist ein KI-Webdesigner. Antworte NUR mit einem vollständigen, lauffähigen "
+    "HTML-Dokument inkl. eingebettetem CSS. Keine externen Skripte/Fonts.\n"
+    "Wenn Bilder vorhanden sind, MUSST du sie sichtbar einbauen. "
+    "Nutze dafür <img src=\"assets/NAME\" alt=\"…\"> und verwende mehrere Bereiche: "
+    "Hero mit großem Bild, Galerie/Portfolio-Grid, und ggf. Feature-Sektion mit kleineren Thumbnails.\n"
+    "- Semantisches HTML, responsives CSS, dunkles Theme erlaubt.\n"
+    "- Gib ausschließlich das vollständige HTML-Dokument zurück."
+)
+SYSTEM_MSG: Final = {"role": "system", "content": SYSTEM_PROMPT}
+
+# User-Nachricht: nur noch Prompt und ggf. Bildliste
+USER_PREFIX: Final[str] = "Erstelle eine moderne One-Page basierend auf:\n\n"
+USER_IMAGES_HEADER: Final[str] = "Verfügbare Bilder (verwende nach Möglichkeit alle):\n"
+
+async def generation_events(payload: dict, bid: str, names: List[str], picked: dict,
+                            key: str, sk: SemanticKey, cached: Optional[str],
+                            cache_tier: str = "hit") -> AsyncIterator[Tuple[str, dict]]:
+    # ("delta", {"text"}) pro Provider-Chunk, zum Schluss ("done", <Antwort wie bisher>)
+    hit = True
+    if cached is not None:
+        html, usage = cached, {"cache": cache_tier}
+        _LLM_CACHE[key] = html
+    elif key in _INFLIGHT:
+        # identischer Request läuft schon: auf dessen Ergebnis warten statt erneut zum Provider
+        html, usage = await asyncio.shield(_INFLIGHT[key]), {"cache": "inflight"}
+    else:
+        hit = False
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda f: f.exception())  # Fehler ohne Wartende nicht als "never retrieved" loggen
+        _INFLIGHT[key] = fut
+        try:
+            parts: List[str] = []
+            usage = {}
+            window, finished, finish_reason = "", False, None
+            # aclosing: beim Abbruch nach </html> wird der Upstream-Stream sofort geschlossen,
+            # der Provider beendet dann die Generierung (und die Abrechnung)
+            async with aclosing(stream_provider(app.state.http, payload)) as chunks:
+                async for chunk in chunks:
+                    if isinstance(chunk.get("usage"), dict):
+                        usage = chunk["usage"]
+                    for choice in chunk.get("choices") or []:
+                        finish_reason = choice.get("finish_reason") or finish_reason
+                        delta = (choice.get("delta") or {}).get("content")
+                        if not delta:
+                            continue
+                        # kurzes Fenster über die Chunk-Grenze, falls "</html>" geteilt ankommt
+                        window = window[-16:] + delta
+                        m = END_HTML_RE.search(window)
+                        if m:
+                            delta = delta[:len(delta) - (len(window) - m.end())]  # Nachgeplapper verwerfen
+                            finished = True
+                        if delta:
+                            parts.append(delta)
+                            yield "delta", {"text": delta}
+                        if finished:
+                            break
+                    if finished:
+                        break
+            # Fences/Fallback erst am Stream-Ende auf dem Gesamttext
+            html, complete = finish_html("".join(parts), finished or finish_reason == "stop")
+            if complete:
+                _LLM_CACHE[key] = html
+            fut.set_result(html)
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            _INFLIGHT.pop(key, None)
+            if not fut.done():  # Client hat den Stream abgebrochen
+                fut.set_exception(HTTPException(status_code=503, detail="Generierung abgebrochen, bitte erneut versuchen"))
+        if complete:
+            # nicht auf Redis/Embedding warten, bevor der Client sein "done" bekommt
+            in_background(redis_store(key, html))
+            in_background(semantic_store(sk, html, payload["model"]))
+
+    # 1) Pfade für gespeicherte Datei sicher RELATIV machen
+    if names:
+        html_saved = fix_img_paths_relative(html, names)
+    else:
+        html_saved = html
+
+    # 2) Für Vorschau ABSOLUT machen
+    html_preview = absolutize_for_preview(html_saved, bid)
+
+    await write_html(bid, html_saved)
+    yield "done", {
+        "bundle_id": bid,
+        "html": html_saved,          # relative Pfade, passt ins ZIP
+        "html_preview": html_preview,# absolute Pfade, funktioniert live
+        "meta": usage,
+        "assets": names,
+        "applied": picked,
+        "cached": hit,
+    }
+
+def sse_frame(event: str, data: dict) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+async def sse_events(events: AsyncIterator[Tuple[str, dict]]) -> AsyncIterator[bytes]:
+    # Status/Header sind bereits gesendet – Fehler gehen als eigenes Event raus
+    try:
+        async for event, data in events:
+            yield sse_frame(event, data)
+    except HTTPException as e:
+        yield sse_frame("error", {"status": e.status_code, "detail": e.detail})
+
 @app.post("/generate")
 async def generate(req: GenReq):
-    if not req.prompt:
+    prompt = (req.prompt or "").strip()
+    if not prompt:
         raise HTTPException(status_code=400, detail="prompt fehlt")
 
-    max_tokens, temperature, picked = choose_tokens_and_temp(req.model, req.max_tokens, req.temperature)
+    requested_max = req.max_tokens if req.max_tokens is not None else adaptive_max_tokens(req.model, prompt)
+    max_tokens, temperature, picked = choose_tokens_and_temp(req.model, requested_max, req.temperature)
     model = picked["model_canonical"]
+    if len(prompt) > MAX_PROMPT_CHARS.get(model, 200_000):
+        raise HTTPException(status_code=413, detail="prompt zu lang für das Kontextfenster des Modells")
 
     bid = ensure_bundle(req.bundle_id)
-    assets_dir = BUNDLES_DIR / bid / "assets"
-    images_on_disk = sorted([p.name for p in assets_dir.glob("*") if p.is_file()])
-    names = [n for n in (req.image_names or images_on_disk) if (assets_dir / n).exists()]
-
-    # Strenger Systemprompt: Bilder MÜSSEN eingebaut werden.
-    system = (
-        "Du bist ein KI-Webdesigner. Antworte NUR mit einem vollständigen, lauffähigen "
-        "HTML-Dokument inkl. eingebettetem CSS. Keine externen Skripte/Fonts.\n"
-        "Wenn Bilder vorhanden sind, MUSST du sie sichtbar einbauen. "
-        "Nutze dafür <img src=\"assets/NAME\" alt=\"…\"> und verwende mehrere Bereiche: "
-        "Hero mit großem Bild, Galerie/Portfolio-Grid, und ggf. Feature-Sektion mit kleineren Thumbnails."
-    )
+    images_on_disk = list_assets(bid)
+    on_disk = set(images_on_disk)
+    names = [n for n in (req.image_names or images_on_disk) if n in on_disk]
 
     images_block = ""
     if names:
-        images_block = "Verfügbare Bilder (verwende nach Möglichkeit alle):\n" + "\n".join([f"- assets/{n}" for n in names]) + "\n"
+        images_block = USER_IMAGES_HEADER + "".join(f"- assets/{n}\n" for n in names)
 
-    user = (
-        f"Erstelle eine moderne One-Page basierend auf:\n\n{req.prompt}\n\n"
-        f"{images_block}"
-        "- Semantisches HTML, responsives CSS, dunkles Theme erlaubt.\n"
-        "- Gib ausschließlich das vollständige HTML-Dokument zurück."
-    )
+    user = USER_PREFIX + prompt + ("\n\n" + images_block if images_block else "")
 
     payload = {
         "model": model,
-        "messages": [
-            {"role": "system", "content": system},
-            {"role": "user",   "content": user},
-        ],
+        "messages": [SYSTEM_MSG, {"role": "user", "content": user}],
         "temperature": temperature,
         "max_tokens": max_tokens,
-        "stream": False,
+        "stream": True,
+        "stream_options": {"include_usage": True},
     }
 
-    data = await call_provider(payload)
-    content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-    html = strip_fences(content)
-
-    if "<html" not in html.lower():
-        html = (
-            "<!DOCTYPE html><html lang='de'><head><meta charset='utf-8'>"
-            "<meta name='viewport' content='width=device-width,initial-scale=1'>"
-            "<title>Entwurf</title><style>body{font-family:Arial;padding:24px;max-width:900px;margin:0 auto}</style>"
-            f"</head><body><h1>Entwurf</h1><pre>{content}</pre></body></html>"
+    key = cache_key(model, temperature, max_tokens, user)
+    sk = semantic_key(model, temperature, prompt, names)
+    cached, cache_tier = await exact_lookup(key), "hit"
+    if cached is None:
+        cached, cache_tier = await semantic_lookup(sk), "semantic"
+
+    events = generation_events(payload, bid, names, picked, key, sk, cached, cache_tier)
+    if req.stream:
+        return StreamingResponse(
+            sse_events(events),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
         )
-
-    # 1) Pfade für gespeicherte Datei sicher RELATIV machen
-    if names:
-        html_saved = fix_img_paths_relative(html, names)
-    else:
-        html_saved = html
-
-    # 2) Für Vorschau ABSOLUT machen
-    html_preview = absolutize_for_preview(html_saved, bid)
-
-    write_html(bid, html_saved)
-    usage = data.get("usage", {}) if isinstance(data.get("usage", {}), dict) else {}
-    return {
-        "bundle_id": bid,
-        "html": html_saved,          # relative Pfade, passt ins ZIP
-        "html_preview": html_preview,# absolute Pfade, funktioniert live
-        "meta": usage,
-        "assets": names,
-        "applied": picked
-    }
+    async with aclosing(events):
+        async for event, data in events:
+            if event == "done":
+                return data
 
 # ---------- ZIP ----------
+ZIP_CHUNK = 1 << 16
+
+class _ChunkBuffer:
+    # nicht-seekbares Ziel für ZipFile; drain() gibt das bisher Geschriebene ab
+    def __init__(self):
+        self.buf = bytearray()
+    def write(self, b) -> int:
+        self.buf.extend(b)
+        return len(b)
+    def flush(self):
+        pass
+    def drain(self) -> bytes:
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+def iter_zip(bundle_dir: Path) -> Iterator[bytes]:
+    # Sync-Generator: StreamingResponse führt ihn im Threadpool aus, Kompression blockiert den Loop nicht
+    buf = _ChunkBuffer()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for path in bundle_dir.rglob("*"):
+            if path.is_file() and ETAGS_DIRNAME not in path.relative_to(bundle_dir).parts:
+                info = zipfile.ZipInfo.from_file(path, arcname=str(path.relative_to(bundle_dir)))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, "rb") as src, z.open(info, "w") as dst:
+                    while chunk := src.read(ZIP_CHUNK):
+                        dst.write(chunk)
+                        if len(buf.buf) >= ZIP_CHUNK:
+                            yield buf.drain()
+                yield buf.drain()
+    yield buf.drain()  # Central Directory
+
 @app.get("/bundle/{bundle_id}.zip")
 def download_bundle(bundle_id: str):
     bundle_dir = BUNDLES_DIR / bundle_id
     if not bundle_dir.exists():
         raise HTTPException(status_code=404, detail="Bundle nicht gefunden")
-    mem = io.BytesIO()
-    with zipfile.ZipFile(mem, "w", compression=zipfile.ZIP_DEFLATED) as z:
-        for path in bundle_dir.rglob("*"):
-            if path.is_file():
-                z.write(path, arcname=str(path.relative_to(bundle_dir)))
-    mem.seek(0)
     headers = {"Content-Disposition": f'attachment; filename="{bundle_id}.zip"'}
-    return StreamingResponse(mem, media_type="application/zip", headers=headers)
+    return StreamingResponse(iter_zip(bundle_dir), media_type="application/zip", headers=headers)
 
 # ---------- Start ----------
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", "8000"))
-    uvicorn.run("server:app", host="0.0.0.0", port=port)
+    # loop/http bleiben auf "auto": uvicorn nimmt uvloop + httptools, sofern installiert
+    # (uvicorn[standard] lässt uvloop unter Windows/PyPy weg, dann asyncio + h11)
+    uvicorn.run(
+        "server:app", host="0.0.0.0", port=port,
+        workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+    )